@@ -4,8 +4,69 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from crewai import Agent, LLM
+from crewai.hooks import register_before_llm_call_hook
 
-from tools import search_tool, read_financial_document
+from tools import get_search_tool, read_financial_document, read_financial_document_stream
+from cache import acquire_rate_limit
+
+# Where CrewAI's system prompt moves from the agent's fixed role/backstory to its
+# goal and tool instructions (see the "role_playing" prompt slice)
+GOAL_MARKER = "\nYour personal goal is:"
+
+
+def split_cacheable_system_prompt(context):
+    """
+    before_llm_call hook: keep only role + backstory in the system message and move
+    the goal and tool instructions to the start of the task message. CrewAI marks
+    the end of the system message as a cache breakpoint, and the financial
+    analyst's goal interpolates the user's {query}, so left in place it would make
+    every request's cached prefix different. DeepSeek's automatic prefix caching
+    gains the same way. Runs once per conversation: the marker is gone afterwards.
+    """
+    messages = context.messages
+    for index, message in enumerate(messages):
+        content = message.get("content")
+        if message.get("role") != "system" or not isinstance(content, str) or GOAL_MARKER not in content:
+            continue
+        follower = next((m for m in messages[index + 1:] if m.get("role") == "user"), None)
+        if follower is None or not isinstance(follower.get("content"), str):
+            return
+        stable, _, rest = content.partition(GOAL_MARKER)
+        message["content"] = stable
+        follower["content"] = GOAL_MARKER.lstrip() + rest + "\n" + follower["content"]
+        return
+
+
+register_before_llm_call_hook(split_cacheable_system_prompt)
+
+
+# Appended to every backstory so agents reuse earlier tool results instead of
+# re-reading the same document on each iteration
+TOOL_REUSE_INSTRUCTION = (
+    " Check previous ToolMessage responses in conversation history before making new tool calls. "
+    "Extract data from previous tool outputs instead of calling tools again with the same parameters."
+)
+
+
+# Calls per minute allowed for each agent role across all workers
+LLM_RATE_LIMIT_RPM = int(os.getenv("LLM_RATE_LIMIT_RPM", "10"))
+
+
+def rate_limit_llm_call(context):
+    """
+    before_llm_call hook: draw each agent LLM call from a Redis token bucket shared
+    by every worker, so each agent role stays within LLM_RATE_LIMIT_RPM overall
+    rather than per process (CrewAI's max_rpm only limits a single Agent instance).
+    A hook rather than an LLM subclass, since LLM(...) hands back a provider-specific
+    class and an overridden call() would never run.
+    """
+    model = getattr(context.llm, "model", context.llm) or "default"
+    role = getattr(context.agent, "role", None) or "default"
+    # One bucket per model and role, so DeepSeek and the extraction model are limited separately
+    acquire_rate_limit(f"ratelimit:{model}:{role}", LLM_RATE_LIMIT_RPM)
+
+
+register_before_llm_call_hook(rate_limit_llm_call)
 
 ### Loading LLM - Using DeepSeek API
 llm = LLM(
@@ -14,12 +75,23 @@ llm = LLM(
     base_url=os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 )
 
+### Loading a cheaper LLM for mechanical reading/extraction work (e.g. ollama/llama3.2:3b).
+# Reasoning stays on DeepSeek; without EXTRACTION_MODEL everything uses DeepSeek.
+if os.getenv("EXTRACTION_MODEL"):
+    extraction_llm = LLM(
+        model=os.getenv("EXTRACTION_MODEL"),
+        api_key=os.getenv("EXTRACTION_API_KEY"),
+        base_url=os.getenv("EXTRACTION_BASE_URL")
+    )
+else:
+    extraction_llm = llm
+
 # Creating an Experienced Financial Analyst agent
 financial_analyst = Agent(
     role="Senior Financial Analyst",
     goal="Provide accurate, data-driven analysis of financial documents to answer the user's query: {query}",
     verbose=True,
-    memory=True,
+    memory=False,
     backstory=(
         "You are an experienced financial analyst with over 15 years of expertise in analyzing "
         "financial statements, market trends, and investment opportunities. You have a strong "
@@ -27,7 +99,7 @@ financial_analyst = Agent(
         "You provide balanced, well-researched insights based solely on the data provided. "
         "You always cite specific figures and metrics from the documents when making assessments. "
         "You maintain professional standards and regulatory compliance in all your analyses."
-    ),
+    ) + TOOL_REUSE_INSTRUCTION,
     tools=[read_financial_document],
     llm=llm,
     max_iter=5,
@@ -40,24 +112,47 @@ verifier = Agent(
     role="Financial Document Verifier",
     goal="Verify the authenticity and validity of uploaded financial documents and ensure they contain proper financial data.",
     verbose=True,
-    memory=True,
+    memory=False,
     backstory=(
         "You are a meticulous document verification specialist with expertise in identifying "
         "legitimate financial documents. You have extensive experience in compliance and "
         "document authentication. You carefully examine document structure, terminology, "
         "and data consistency to ensure the documents are genuine financial reports. "
-        "You flag any inconsistencies or potential issues in the documentation."
-    ),
+        "You flag any inconsistencies or potential issues in the documentation. "
+        "Once you have read the document, return a single JSON object "
+        "{\"verified\": true/false, \"reasons\": [...]} and stop."
+    ) + TOOL_REUSE_INSTRUCTION,
     tools=[read_financial_document],
-    llm=llm,
-    max_iter=5,
+    llm=extraction_llm,
+    max_iter=2,
     max_rpm=10,
     allow_delegation=True
 )
 
 
-# Build tools list for investment advisor (conditionally include search_tool)
+# Creating a document reader agent the analyst can delegate extraction to
+document_reader = Agent(
+    role="Financial Document Reader",
+    goal="Extract the exact figures, tables and statements requested from financial documents, without interpretation.",
+    verbose=True,
+    memory=False,
+    backstory=(
+        "You are a precise financial data extraction specialist. You read financial documents "
+        "and report the requested figures, line items and passages exactly as they appear, "
+        "including units, periods and currencies. You do not analyze, interpret or speculate; "
+        "you only return what the document says."
+    ) + TOOL_REUSE_INSTRUCTION,
+    tools=[read_financial_document, read_financial_document_stream],
+    llm=extraction_llm,
+    max_iter=5,
+    max_rpm=10,
+    allow_delegation=False
+)
+
+
+# Build tools list for investment advisor (conditionally include the search tool)
 investment_advisor_tools = [read_financial_document]
+search_tool = get_search_tool()
 if search_tool:
     investment_advisor_tools.append(search_tool)
 
@@ -65,7 +160,7 @@ investment_advisor = Agent(
     role="Investment Advisor",
     goal="Provide sound, compliant investment recommendations based on thorough analysis of financial documents and market conditions.",
     verbose=True,
-    memory=True,
+    memory=False,
     backstory=(
         "You are a certified financial advisor with a fiduciary responsibility to clients. "
         "You hold CFA and CFP certifications and have extensive experience in portfolio management. "
@@ -73,7 +168,7 @@ investment_advisor = Agent(
         "individual financial goals. You always disclose potential conflicts of interest and "
         "ensure all recommendations comply with SEC and FINRA regulations. "
         "You base your recommendations on thorough fundamental and technical analysis."
-    ),
+    ) + TOOL_REUSE_INSTRUCTION,
     tools=investment_advisor_tools,
     llm=llm,
     max_iter=5,
@@ -86,7 +181,7 @@ risk_assessor = Agent(
     role="Risk Assessment Specialist",
     goal="Conduct thorough risk analysis of financial documents and provide actionable risk management recommendations.",
     verbose=True,
-    memory=True,
+    memory=False,
     backstory=(
         "You are an experienced risk management professional with expertise in financial risk assessment. "
         "You have worked with institutional investors and understand various risk frameworks including "
@@ -94,7 +189,7 @@ risk_assessor = Agent(
         "market risk, credit risk, liquidity risk, and operational risk. "
         "You recommend appropriate diversification strategies and risk mitigation techniques based on "
         "data-driven analysis rather than speculation."
-    ),
+    ) + TOOL_REUSE_INSTRUCTION,
     tools=[read_financial_document],
     llm=llm,
     max_iter=5,
@@ -0,0 +1,159 @@
+"""
+Redis helpers: cache for job results and statuses served by the API, job status
+events, and a rate limiter shared by all workers
+"""
+import os
+import json
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Same Redis instance Celery uses as its broker
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+RESULT_TTL = 3600  # results never change once stored
+STATUS_TTL = 2  # short, so polls still see transitions quickly; the DB stays authoritative
+RETRY_AFTER = 30  # seconds to skip the cache after Redis could not be reached
+
+try:
+    import redis
+    from redis import asyncio as redis_asyncio
+    redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    # Used by the API's status stream; no socket timeout since subscribers block waiting for messages
+    async_redis_client = redis_asyncio.Redis.from_url(REDIS_URL)
+except ImportError:
+    redis_client = None
+    async_redis_client = None
+
+# While Redis is unreachable, requests go straight to the database instead of
+# each paying the connection timeout
+_disabled_until = 0.0
+
+
+def result_key(job_id: str) -> str:
+    return f"result:{job_id}"
+
+
+def status_key(job_id: str) -> str:
+    return f"status:{job_id}"
+
+
+def status_channel(job_id: str) -> str:
+    return f"job:{job_id}:status"
+
+
+def _available() -> bool:
+    return redis_client is not None and time.monotonic() >= _disabled_until
+
+
+def _disable():
+    global _disabled_until
+    _disabled_until = time.monotonic() + RETRY_AFTER
+
+
+def cache_get_raw(key: str):
+    """Return the cached JSON for key as bytes, or None on a miss or Redis error"""
+    if not _available():
+        return None
+    try:
+        return redis_client.get(key)
+    except redis.RedisError:
+        _disable()
+        return None
+
+
+def cache_get(key: str):
+    """Return the cached JSON value for key, or None on a miss or Redis error"""
+    value = cache_get_raw(key)
+    return json.loads(value) if value else None
+
+
+def cache_set(key: str, value: dict, ttl: int):
+    """Store value as JSON under key for ttl seconds, ignoring Redis errors"""
+    if not _available():
+        return
+    try:
+        redis_client.setex(key, ttl, json.dumps(value))
+    except redis.RedisError:
+        _disable()
+
+
+def cache_delete(key: str):
+    """Drop key from the cache, ignoring Redis errors"""
+    if not _available():
+        return
+    try:
+        redis_client.delete(key)
+    except redis.RedisError:
+        _disable()
+
+
+def notify_status(job_id: str, status: str, **fields):
+    """
+    Announce a job status change: drop the cached status and publish the new one
+    to the job's channel for /status/{job_id}/stream subscribers
+    """
+    cache_delete(status_key(job_id))
+    if not _available():
+        return
+    try:
+        redis_client.publish(status_channel(job_id), json.dumps({"job_id": job_id, "status": status, **fields}))
+    except redis.RedisError:
+        _disable()
+
+
+def result_payload(job_id: str, filename: str, query: str, analysis: str, processing_time: float, created_at) -> dict:
+    """Build the /result/{job_id} response body for a completed job"""
+    return {
+        "status": "success",
+        "job_id": job_id,
+        "filename": filename,
+        "query": query,
+        "analysis": analysis,
+        "processing_time": processing_time,
+        "created_at": created_at.isoformat()
+    }
+
+
+# Token bucket kept in a Redis hash, refilled continuously at the configured rate and
+# timed with the Redis server clock so every worker sees the same bucket. Takes a
+# token and returns 0, or returns how many milliseconds to wait for the next one.
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_per_ms = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * refill_per_ms)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / refill_per_ms)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / refill_per_ms) + 1000)
+return wait
+"""
+
+_token_bucket = redis_client.register_script(_TOKEN_BUCKET_SCRIPT) if redis_client is not None else None
+
+
+def acquire_rate_limit(key: str, per_minute: int):
+    """
+    Block until the shared bucket under key allows another call, at most
+    per_minute calls per minute across all processes. Does not block when
+    Redis is unavailable.
+    """
+    while _available():
+        try:
+            wait_ms = _token_bucket(keys=[key], args=[per_minute, per_minute / 60000])
+        except redis.RedisError:
+            _disable()
+            return
+        if not wait_ms:
+            return
+        time.sleep(wait_ms / 1000)
@@ -18,6 +18,17 @@ celery_app = Celery(
     include=["celery_worker"]
 )
 
+# Worker pool. "prefork" (default) runs one job per process; "threads" lets one
+# process keep many jobs in flight while they wait on LLM HTTP calls. gevent is
+# not accepted here: Celery only monkey-patches the standard library when the pool
+# is given as --pool on the command line, and an unpatched gevent pool runs one
+# job at a time and shares thread-locals across greenlets.
+CELERY_POOL = os.getenv("CELERY_POOL", "prefork")
+if CELERY_POOL not in ("prefork", "threads", "solo"):
+    print(f"⚠ Warning: CELERY_POOL={CELERY_POOL} is not supported, using prefork (pass --pool on the command line instead)")
+    CELERY_POOL = "prefork"
+CELERY_CONCURRENCY = os.getenv("CELERY_CONCURRENCY")
+
 # Celery configuration
 celery_app.conf.update(
     task_serializer="json",
@@ -28,6 +39,10 @@ celery_app.conf.update(
     task_track_started=True,
     task_time_limit=600,  # 10 minutes max
     task_soft_time_limit=540,  # 9 minutes soft limit
+    worker_pool=CELERY_POOL,
     worker_prefetch_multiplier=1,
     worker_max_tasks_per_child=50,
 )
+
+if CELERY_CONCURRENCY:
+    celery_app.conf.worker_concurrency = int(CELERY_CONCURRENCY)
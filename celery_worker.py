@@ -2,24 +2,208 @@
 Celery worker tasks for asynchronous financial document analysis
 """
 import os
+import threading
 import time
-from datetime import datetime
 from celery_config import celery_app
+from sqlalchemy import insert, update, select, func
+from sqlalchemy.exc import OperationalError
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Configure embeddings before importing crewai
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
-
-import embeddings_config
 from crewai import Crew, Process
-from agents import financial_analyst
-from task import analyze_financial_document_task
+from task import crew_agents, crew_tasks
+from tools import clear_tool_cache
 from database import SessionLocal, AnalysisRequest, AnalysisResult, UserActivity
+from cache import cache_set, notify_status, result_key, result_payload, RESULT_TTL
+
+# Failures worth retrying: network trouble reaching the LLM API or the database.
+# Anything else fails the job straight away.
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError)
+try:
+    from litellm.exceptions import APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout
+    TRANSIENT_ERRORS += (APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout)
+except ImportError:
+    pass
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a failed attempt is worth retrying. Database OperationalErrors only
+    count when the connection dropped or SQLite was locked; the rest (e.g. "no such
+    column" on an outdated schema) would fail the same way on every retry.
+    """
+    if isinstance(error, OperationalError):
+        return error.connection_invalidated or "database is locked" in str(error)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+# Build the crew once per worker process (at boot, not on the first task) and
+# reuse it. Kickoff keeps per-run state on the crew and its agents, so under the
+# threads/gevent pools every other thread or greenlet gets its own copy.
+financial_crew = Crew(
+    agents=crew_agents,
+    tasks=crew_tasks,
+    process=Process.sequential,
+)
+_thread_crews = threading.local()
+
+
+def get_financial_crew() -> Crew:
+    """Return the calling thread's crew, copying the boot-time crew on first use"""
+    crew = getattr(_thread_crews, "crew", None)
+    if crew is None:
+        if threading.current_thread() is threading.main_thread():
+            crew = financial_crew
+        else:
+            crew = financial_crew.copy()
+        _thread_crews.crew = crew
+    return crew
+
+
+def remove_file(file_path: str):
+    """Delete an uploaded file, ignoring errors"""
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except:
+            pass
+
 
+def extract_analysis_text(result) -> str:
+    """Get the analysis text from a CrewAI kickoff result"""
+    if isinstance(result, str):
+        return result
+    elif hasattr(result, 'raw'):
+        return result.raw
+    elif hasattr(result, 'output'):
+        return result.output
+    else:
+        return str(result)
 
-@celery_app.task(bind=True, name="analyze_financial_document")
+
+def mark_job_processing(db, job_id: str):
+    """Flag a job as processing with a single UPDATE"""
+    db.execute(
+        update(AnalysisRequest.__table__)
+        .where(AnalysisRequest.__table__.c.job_id == job_id)
+        .values(status="processing")
+    )
+    db.commit()
+    notify_status(job_id, "processing")
+
+
+def insert_ignoring_duplicate_job(db, table):
+    """INSERT for table that silently skips a row whose job_id is already stored"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return insert(table)
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=["job_id"])
+
+
+def finish_if_already_analyzed(db, job_id: str):
+    """
+    If an earlier attempt of this job already stored its result (e.g. the task
+    was redelivered or retried after the commit), mark the job completed and
+    return the task result without running the crew again. Returns None otherwise.
+    """
+    results = AnalysisResult.__table__
+    row = db.execute(
+        select(results.c.filename, results.c.analysis, results.c.processing_time)
+        .where(results.c.job_id == job_id)
+    ).first()
+    if row is None:
+        return None
+    
+    db.execute(
+        update(AnalysisRequest.__table__)
+        .where(AnalysisRequest.__table__.c.job_id == job_id)
+        .where(AnalysisRequest.__table__.c.status != "completed")
+        .values(status="completed", completed_at=func.now())
+    )
+    db.commit()
+    notify_status(job_id, "completed")
+    
+    return {
+        "status": "completed",
+        "job_id": job_id,
+        "analysis": row.analysis,
+        "processing_time": row.processing_time,
+        "filename": row.filename
+    }
+
+
+def record_job_success(db, job_id: str, filename: str, query: str, analysis_text: str, processing_time: float, user_ip: str = None, file_size: int = None):
+    """Store the result, log the activity and complete the job in one transaction"""
+    # Timestamps are filled in by the database; RETURNING hands back the result's
+    # created_at for the cached /result payload
+    row = db.execute(
+        insert_ignoring_duplicate_job(db, AnalysisResult.__table__)
+        .values(
+            job_id=job_id,
+            filename=filename,
+            query=query,
+            analysis=analysis_text,
+            processing_time=processing_time
+        )
+        .returning(AnalysisResult.__table__.c.created_at)
+    ).first()
+    # No row back means the INSERT was skipped, not that created_at is empty
+    if row is None:
+        # A concurrent attempt of the same job got there first and has already
+        # logged the activity and completed the request in its transaction
+        db.rollback()
+        return
+    
+    db.execute(
+        insert(UserActivity.__table__),
+        [{
+            "job_id": job_id,
+            "user_ip": user_ip,
+            "file_size": file_size,
+            "query_length": len(query),
+            "success": True
+        }]
+    )
+    db.execute(
+        update(AnalysisRequest.__table__)
+        .where(AnalysisRequest.__table__.c.job_id == job_id)
+        .values(status="completed", completed_at=func.now())
+    )
+    db.commit()
+    
+    # Pre-warm the result cache for the client's first /result call
+    cache_set(result_key(job_id), result_payload(job_id, filename, query, analysis_text, processing_time, row.created_at), RESULT_TTL)
+    notify_status(job_id, "completed")
+
+
+def record_job_failure(db, job_id: str, error_message: str, query: str, user_ip: str = None, file_size: int = None):
+    """Fail the job and log the activity in one transaction"""
+    # Discard anything left over from the failed attempt
+    db.rollback()
+    db.execute(
+        update(AnalysisRequest.__table__)
+        .where(AnalysisRequest.__table__.c.job_id == job_id)
+        .values(status="failed", error_message=error_message, completed_at=func.now())
+    )
+    db.execute(
+        insert(UserActivity.__table__),
+        [{
+            "job_id": job_id,
+            "user_ip": user_ip,
+            "file_size": file_size,
+            "query_length": len(query) if query else 0,
+            "success": False
+        }]
+    )
+    db.commit()
+    notify_status(job_id, "failed", error=error_message)
+
+
+@celery_app.task(bind=True, name="analyze_financial_document", autoretry_for=TRANSIENT_ERRORS, retry_backoff=True, retry_backoff_max=120, max_retries=3)
 def analyze_financial_document_task_celery(self, job_id: str, file_path: str, query: str, filename: str, user_ip: str = None, file_size: int = None):
     """
     Celery task for analyzing financial documents asynchronously
@@ -34,73 +218,30 @@ def analyze_financial_document_task_celery(self, job_id: str, file_path: str, qu
     """
     db = SessionLocal()
     start_time = time.time()
+    retrying = False
     
     try:
+        # Skip the crew entirely if an earlier attempt already stored the result
+        existing = finish_if_already_analyzed(db, job_id)
+        if existing is not None:
+            return existing
+        
         # Update status to processing
-        db_request = db.query(AnalysisRequest).filter(AnalysisRequest.job_id == job_id).first()
-        if db_request:
-            db_request.status = "processing"
-            db_request.updated_at = datetime.utcnow()
-            db.commit()
+        mark_job_processing(db, job_id)
         
         # Update task state
         self.update_state(state='PROCESSING', meta={'status': 'Analyzing document...'})
         
         # Run the financial analysis crew
-        financial_crew = Crew(
-            agents=[financial_analyst],
-            tasks=[analyze_financial_document_task],
-            process=Process.sequential,
-        )
-        
-        result = financial_crew.kickoff(inputs={'query': query, 'file_path': file_path})
+        result = get_financial_crew().kickoff(inputs={'query': query, 'file_path': file_path})
         
         # Extract result text
-        if isinstance(result, str):
-            analysis_text = result
-        elif hasattr(result, 'raw'):
-            analysis_text = result.raw
-        elif hasattr(result, 'output'):
-            analysis_text = result.output
-        else:
-            analysis_text = str(result)
+        analysis_text = extract_analysis_text(result)
         
         processing_time = time.time() - start_time
         
-        # Store result in database
-        db_result = AnalysisResult(
-            job_id=job_id,
-            filename=filename,
-            query=query,
-            analysis=analysis_text,
-            processing_time=processing_time
-        )
-        db.add(db_result)
-        
-        # Update request status
-        if db_request:
-            db_request.status = "completed"
-            db_request.completed_at = datetime.utcnow()
-            db_request.updated_at = datetime.utcnow()
-        
-        # Log user activity
-        activity = UserActivity(
-            job_id=job_id,
-            user_ip=user_ip,
-            file_size=file_size,
-            query_length=len(query),
-            success=True
-        )
-        db.add(activity)
-        
-        db.commit()
-        
-        # Clean up file
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass
+        # Store result, log user activity and update request status
+        record_job_success(db, job_id, filename, query, analysis_text, processing_time, user_ip, file_size)
         
         return {
             "status": "completed",
@@ -111,38 +252,111 @@ def analyze_financial_document_task_celery(self, job_id: str, file_path: str, qu
         }
         
     except Exception as e:
+        if is_transient(e) and self.request.retries < self.max_retries:
+            # Leave the job processing and its files in place for the retry
+            retrying = True
+            db.rollback()
+            if isinstance(e, OperationalError):
+                # Not covered by autoretry_for, so schedule it with the same backoff
+                raise self.retry(exc=e, countdown=min(2 ** self.request.retries, 120))
+            raise
+        
         processing_time = time.time() - start_time
         error_message = str(e)
         
-        # Update request status to failed
-        db_request = db.query(AnalysisRequest).filter(AnalysisRequest.job_id == job_id).first()
-        if db_request:
-            db_request.status = "failed"
-            db_request.error_message = error_message
-            db_request.updated_at = datetime.utcnow()
-            db_request.completed_at = datetime.utcnow()
+        # Update request status to failed and log failed activity
+        record_job_failure(db, job_id, error_message, query, user_ip, file_size)
         
-        # Log failed activity
-        activity = UserActivity(
-            job_id=job_id,
-            user_ip=user_ip,
-            file_size=file_size,
-            query_length=len(query) if query else 0,
-            success=False
+        # Re-raise exception for Celery to handle
+        raise
+        
+    finally:
+        # Clean up file
+        clear_tool_cache(file_path)
+        if not retrying:
+            remove_file(file_path)
+        db.close()
+
+
+@celery_app.task(bind=True, name="analyze_financial_document_batch", autoretry_for=TRANSIENT_ERRORS, retry_backoff=True, retry_backoff_max=120, max_retries=3)
+def analyze_financial_document_batch_celery(self, job_id: str, file_paths: list, query: str, filenames: list, user_ip: str = None, file_size: int = None):
+    """
+    Celery task for analyzing several financial documents as one job
+    
+    All documents run through the shared crew in a single kickoff_for_each
+    call, and the per-document analyses are stored as one combined result.
+    
+    Args:
+        job_id: Unique job identifier for the whole batch
+        file_paths: Paths to the uploaded PDF files
+        query: Analysis query applied to every document
+        filenames: Original filenames, in the same order as file_paths
+        user_ip: User's IP address (optional)
+        file_size: Total size of all files in bytes (optional)
+    """
+    db = SessionLocal()
+    start_time = time.time()
+    retrying = False
+    
+    try:
+        # Skip the crew entirely if an earlier attempt already stored the result
+        existing = finish_if_already_analyzed(db, job_id)
+        if existing is not None:
+            return existing
+        
+        # Update status to processing
+        mark_job_processing(db, job_id)
+        
+        # Update task state
+        self.update_state(state='PROCESSING', meta={'status': f'Analyzing {len(file_paths)} documents...'})
+        
+        # Run every document through the crew in one batch
+        results = get_financial_crew().kickoff_for_each(
+            inputs=[{'query': query, 'file_path': file_path} for file_path in file_paths]
         )
-        db.add(activity)
         
-        db.commit()
+        # Combine per-document analyses into a single report
+        analysis_text = "\n\n".join(
+            f"## {filename}\n\n{extract_analysis_text(result)}"
+            for filename, result in zip(filenames, results)
+        )
         
-        # Clean up file
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass
+        processing_time = time.time() - start_time
+        
+        # Store result, log user activity and update request status
+        record_job_success(db, job_id, ", ".join(filenames)[:255], query, analysis_text, processing_time, user_ip, file_size)
+        
+        return {
+            "status": "completed",
+            "job_id": job_id,
+            "analysis": analysis_text,
+            "processing_time": processing_time,
+            "filenames": filenames
+        }
+        
+    except Exception as e:
+        if is_transient(e) and self.request.retries < self.max_retries:
+            # Leave the job processing and its files in place for the retry
+            retrying = True
+            db.rollback()
+            if isinstance(e, OperationalError):
+                # Not covered by autoretry_for, so schedule it with the same backoff
+                raise self.retry(exc=e, countdown=min(2 ** self.request.retries, 120))
+            raise
+        
+        processing_time = time.time() - start_time
+        error_message = str(e)
+        
+        # Update request status to failed and log failed activity
+        record_job_failure(db, job_id, error_message, query, user_ip, file_size)
         
         # Re-raise exception for Celery to handle
         raise
         
     finally:
+        # Clean up files
+        for file_path in file_paths:
+            clear_tool_cache(file_path)
+            if not retrying:
+                remove_file(file_path)
         db.close()
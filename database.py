@@ -1,10 +1,10 @@
 """
 Database models and configuration for storing analysis results and user data
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float, Boolean, Index, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from sqlalchemy.sql import func
 import os
 from dotenv import load_dotenv
 
@@ -16,9 +16,27 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./financial_analyzer.db")
 # Create engine
 engine = create_engine(
     DATABASE_URL, 
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
+    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {},
+    pool_pre_ping="sqlite" not in DATABASE_URL
 )
 
+# SQLite tuning applied to every new connection. WAL lets API reads (e.g. /status
+# polls) proceed while a worker is committing instead of waiting on the write lock.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-65536",  # 64 MB
+)
+
+if "sqlite" in DATABASE_URL:
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -35,10 +53,13 @@ class AnalysisRequest(Base):
     filename = Column(String(255), nullable=False)
     query = Column(Text, nullable=False)
     status = Column(String(20), default="pending")  # pending, processing, completed, failed
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # default renders NOW() into each INSERT, so tables created before the column
+    # had a server default still get timestamps
+    created_at = Column(DateTime, default=func.now(), server_default=func.now())
+    updated_at = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     completed_at = Column(DateTime, nullable=True)
     error_message = Column(Text, nullable=True)
+    batch_size = Column(Integer, nullable=True)  # number of files in a batch job, None for single-file jobs
 
 
 class AnalysisResult(Base):
@@ -51,7 +72,7 @@ class AnalysisResult(Base):
     query = Column(Text, nullable=False)
     analysis = Column(Text, nullable=False)
     processing_time = Column(Float, nullable=True)  # in seconds
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=func.now(), server_default=func.now())
 
 
 class UserActivity(Base):
@@ -64,12 +85,38 @@ class UserActivity(Base):
     file_size = Column(Integer, nullable=True)  # in bytes
     query_length = Column(Integer, nullable=True)
     success = Column(Boolean, default=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=func.now(), server_default=func.now())
+
+
+# Serves the /stats status breakdown (/history pages by primary key)
+Index("ix_requests_status", AnalysisRequest.status)
+
+
+def add_missing_columns():
+    """
+    Add nullable columns defined on the models but missing from existing tables
+    (create_all only creates tables that don't exist yet), e.g. batch_size on a
+    database created before batch jobs
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if not column.nullable or column.server_default is not None:
+                    print(f"⚠ Warning: Column {table.name}.{column.name} is missing and must be added manually")
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                print(f"✓ Added column {table.name}.{column.name}")
 
 
 def init_db():
-    """Initialize database by creating all tables"""
+    """Initialize database by creating all tables and adding new columns to old ones"""
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
     print("✓ Database initialized successfully")
 
 
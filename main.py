@@ -1,56 +1,114 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Request, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy import select, func, case
 from sqlalchemy.orm import Session
 from typing import Optional, List
+import asyncio
+import json
 import os
+import threading
+import time
+import types
 import uuid
+import aiofiles
 from datetime import datetime
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Configure embeddings before importing crewai
-os.environ["TOKENIZERS_PARALLELISM"] = "false"  # Avoid tokenizer warnings
-
-# Import and configure embeddings
-import embeddings_config
-
 from crewai import Crew, Process
-from agents import financial_analyst
-from task import analyze_financial_document_task
+from crewai.hooks import HookAborted
+from task import crew_agents, crew_tasks
+from tools import clear_tool_cache
 
 # Import database and Celery
-from database import get_db, AnalysisRequest, AnalysisResult, UserActivity, init_db
+from database import get_db, SessionLocal, AnalysisRequest, AnalysisResult, UserActivity, init_db
+from cache import cache_get, cache_get_raw, cache_set, result_key, status_key, status_channel, result_payload, async_redis_client, RESULT_TTL, STATUS_TTL
 
 # Initialize database
 init_db()
 
 # Try to import Celery (optional for backward compatibility)
 try:
-    from celery_worker import analyze_financial_document_task_celery
+    from celery_worker import analyze_financial_document_task_celery, analyze_financial_document_batch_celery
     CELERY_ENABLED = True
     print("✓ Celery integration enabled")
 except ImportError:
     CELERY_ENABLED = False
     print("⚠ Celery not available - async processing disabled")
 
+# Maximum number of files accepted by /analyze/batch
+MAX_BATCH_SIZE = 32
+
+# /history pages are the largest JSON responses. With a declared return type FastAPI
+# serializes them straight to JSON through pydantic instead of via jsonable_encoder.
+class HistoryItem(BaseModel):
+    job_id: str
+    filename: str
+    query: str
+    processing_time: Optional[float]
+    created_at: str
+
+
+class HistoryPage(BaseModel):
+    total: Optional[int]
+    limit: int
+    offset: int
+    next_cursor: Optional[str]
+    results: List[HistoryItem]
+
 app = FastAPI(
     title="Financial Document Analyzer",
     description="AI-powered financial document analysis with queue-based processing and database storage",
     version="2.0.0"
 )
 
-def run_crew(query: str, file_path: str = "data/sample.pdf"):
-    """Run the financial analysis crew with the given query and file path."""
-    financial_crew = Crew(
-        agents=[financial_analyst],
-        tasks=[analyze_financial_document_task],
-        process=Process.sequential,
-    )
-    
-    # Pass both query and file_path to the crew
-    result = financial_crew.kickoff(inputs={'query': query, 'file_path': file_path})
+# Build the crew once; only kickoff inputs vary. Kickoff stores per-run state on
+# the crew and its agents, so each worker thread runs its own copy and concurrent
+# requests never wait on each other.
+financial_crew = Crew(
+    agents=crew_agents,
+    tasks=crew_tasks,
+    process=Process.sequential,
+)
+_thread_crews = threading.local()
+
+def get_financial_crew():
+    """
+    Return the calling thread's copy of the crew, with an on_step slot that its
+    step callback forwards agent steps to, and a cancelled slot it checks first
+    """
+    crew = getattr(_thread_crews, "crew", None)
+    if crew is None:
+        slot = _thread_crews.slot = types.SimpleNamespace(on_step=None, cancelled=None)
+        
+        def forward_step(step):
+            # HookAborted stops the run outright instead of being retried by the agent
+            if slot.cancelled is not None and slot.cancelled.is_set():
+                raise HookAborted("Analysis cancelled by the client")
+            if slot.on_step is not None:
+                slot.on_step(step)
+        
+        crew = _thread_crews.crew = financial_crew.copy()
+        crew.step_callback = forward_step
+    return crew, _thread_crews.slot
+
+def run_crew(query: str, file_path: str = "data/sample.pdf", on_step=None, cancelled: threading.Event = None):
+    """Run the financial analysis crew with the given query and file path.
+    If given, on_step is called with each intermediate agent step as it happens,
+    and the run is aborted at the next step once cancelled is set."""
+    crew, slot = get_financial_crew()
+    # The crew belongs to this thread, so the listener only sees this run's steps
+    slot.on_step = on_step
+    slot.cancelled = cancelled
+    try:
+        # Pass both query and file_path to the crew
+        result = crew.kickoff(inputs={'query': query, 'file_path': file_path})
+    finally:
+        slot.on_step = None
+        slot.cancelled = None
     
     # Handle both string and object results from CrewAI
     if isinstance(result, str):
@@ -62,6 +120,118 @@ def run_crew(query: str, file_path: str = "data/sample.pdf"):
     else:
         return str(result)
 
+# Uploads are copied to disk in fixed-size chunks so memory stays flat regardless of file size
+UPLOAD_CHUNK_SIZE = 1 << 16
+
+# Seconds between keep-alives on /status/{job_id}/stream, each also a chance to
+# re-check the database in case a status message was missed, and the longest the
+# stream stays open (well past the worker's time limit plus retries)
+STATUS_STREAM_KEEPALIVE = 15.0
+STATUS_STREAM_DEADLINE = 3600
+
+
+async def save_upload(file: UploadFile, file_path: str) -> int:
+    """Stream an uploaded file to file_path and return its size in bytes"""
+    size = 0
+    async with aiofiles.open(file_path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            await out.write(chunk)
+    return size
+
+def cleanup_upload(file_path: str):
+    """Drop cached tool outputs and delete an uploaded file, ignoring errors"""
+    clear_tool_cache(file_path)
+    if os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except:
+            pass  # Ignore cleanup errors
+
+
+def save_streamed_result(job_id: str, filename: str, query: str, analysis: str, processing_time: float, user_ip: str = None, file_size: int = None):
+    """
+    Persist a streamed /analyze call the way the worker records a finished job:
+    the completed request, its result and the activity row, in one transaction
+    """
+    db = SessionLocal()
+    try:
+        db.add(AnalysisRequest(
+            job_id=job_id,
+            filename=filename,
+            query=query,
+            status="completed",
+            completed_at=func.now()
+        ))
+        db.add(AnalysisResult(
+            job_id=job_id,
+            filename=filename,
+            query=query,
+            analysis=analysis,
+            processing_time=processing_time
+        ))
+        db.add(UserActivity(
+            job_id=job_id,
+            user_ip=user_ip,
+            file_size=file_size,
+            query_length=len(query),
+            success=True
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def stream_analysis(job_id: str, query: str, file_path: str, filename: str, user_ip: str = None, file_size: int = None):
+    """
+    Run the crew in a worker thread and yield Server-Sent Events: one "step" event
+    per intermediate agent step, then a "result" (or "error") event at the end.
+    If the client disconnects, the crew is cancelled at its next step.
+    """
+    loop = asyncio.get_running_loop()
+    steps = asyncio.Queue()
+    cancelled = threading.Event()
+    start_time = time.time()
+    
+    def on_step(step):
+        text = getattr(step, "text", None) or getattr(step, "output", None) or str(step)
+        loop.call_soon_threadsafe(steps.put_nowait, text)
+    
+    def run():
+        try:
+            return run_crew(query=query, file_path=file_path, on_step=on_step, cancelled=cancelled)
+        finally:
+            loop.call_soon_threadsafe(steps.put_nowait, None)
+    
+    crew_run = asyncio.ensure_future(asyncio.to_thread(run))
+    try:
+        while (text := await steps.get()) is not None:
+            yield f"event: step\ndata: {json.dumps({'text': text})}\n\n"
+        
+        analysis = await crew_run
+        processing_time = time.time() - start_time
+        await asyncio.to_thread(save_streamed_result, job_id, filename, query, analysis, processing_time, user_ip, file_size)
+        
+        payload = {
+            "status": "success",
+            "job_id": job_id,
+            "query": query,
+            "analysis": analysis,
+            "file_processed": filename
+        }
+        yield f"event: result\ndata: {json.dumps(payload)}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps({'detail': f'Error processing financial document: {str(e)}'})}\n\n"
+    finally:
+        if crew_run.done():
+            cleanup_upload(file_path)
+        else:
+            # Client went away mid-run: stop the crew at its next step and clean
+            # up once it is done with the file
+            cancelled.set()
+            crew_run.add_done_callback(lambda _: cleanup_upload(file_path))
+
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -77,32 +247,45 @@ async def root():
 
 @app.post("/analyze")
 async def analyze_document(
+    request: Request,
     file: UploadFile = File(...),
-    query: str = Form(default="Analyze this financial document for investment insights")
+    query: str = Form(default="Analyze this financial document for investment insights"),
+    stream: bool = Form(default=False)
 ):
     """
     [SYNCHRONOUS] Analyze financial document and provide comprehensive investment recommendations.
     This endpoint blocks until analysis is complete. For async processing, use /analyze/async instead.
+    
+    With stream=true the response is a text/event-stream of agent steps as they happen,
+    ending with the full result, which is also stored for /result/{job_id}.
     """
     
     file_id = str(uuid.uuid4())
     file_path = f"data/financial_document_{file_id}.pdf"
+    streaming = False
     
     try:
         # Ensure data directory exists
         os.makedirs("data", exist_ok=True)
         
         # Save uploaded file
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        file_size = await save_upload(file, file_path)
         
         # Validate query
         if query == "" or query is None:
             query = "Analyze this financial document for investment insights"
             
-        # Process the financial document with all analysts
-        response = run_crew(query=query.strip(), file_path=file_path)
+        if stream:
+            # The stream owns the uploaded file from here and cleans it up when done
+            streaming = True
+            client_ip = request.client.host if request.client else None
+            return StreamingResponse(
+                stream_analysis(file_id, query.strip(), file_path, file.filename, client_ip, file_size),
+                media_type="text/event-stream"
+            )
+        
+        # Process the financial document with all analysts (off the event loop)
+        response = await asyncio.to_thread(run_crew, query=query.strip(), file_path=file_path)
         
         return {
             "status": "success",
@@ -115,12 +298,9 @@ async def analyze_document(
         raise HTTPException(status_code=500, detail=f"Error processing financial document: {str(e)}")
     
     finally:
-        # Clean up uploaded file
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass  # Ignore cleanup errors
+        # Drop cached tool outputs and clean up uploaded file
+        if not streaming:
+            cleanup_upload(file_path)
 
 
 @app.post("/analyze/async")
@@ -150,11 +330,7 @@ async def analyze_document_async(
         os.makedirs("data", exist_ok=True)
         
         # Save uploaded file
-        content = await file.read()
-        file_size = len(content)
-        
-        with open(file_path, "wb") as f:
-            f.write(content)
+        file_size = await save_upload(file, file_path)
         
         # Validate query
         if query == "" or query is None:
@@ -171,7 +347,7 @@ async def analyze_document_async(
             status="pending"
         )
         db.add(db_request)
-        db.commit()
+        await asyncio.to_thread(db.commit)
         
         # Submit task to Celery
         analyze_financial_document_task_celery.delay(
@@ -201,10 +377,100 @@ async def analyze_document_async(
         raise HTTPException(status_code=500, detail=f"Error submitting document for analysis: {str(e)}")
 
 
-@app.get("/status/{job_id}")
-async def get_job_status(job_id: str, db: Session = Depends(get_db)):
+@app.post("/analyze/batch")
+async def analyze_document_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    query: str = Form(default="Analyze this financial document for investment insights"),
+    db: Session = Depends(get_db)
+):
+    """
+    [ASYNCHRONOUS] Submit several financial documents as a single batch job.
+    All files are analyzed with the same query by one worker task, and the combined
+    report is available from /result/{job_id} once the job completes.
+    
+    Requires: Redis and Celery worker running
+    """
+    if not CELERY_ENABLED:
+        raise HTTPException(
+            status_code=503, 
+            detail="Async processing not available. Redis/Celery not configured. Use /analyze endpoint instead."
+        )
+    
+    if len(files) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files in batch: {len(files)}. Maximum is {MAX_BATCH_SIZE}."
+        )
+    
+    job_id = str(uuid.uuid4())
+    file_paths = [f"data/financial_document_{job_id}_{i}.pdf" for i in range(len(files))]
+    filenames = [file.filename for file in files]
+    
+    try:
+        # Ensure data directory exists
+        os.makedirs("data", exist_ok=True)
+        
+        # Save uploaded files
+        file_size = 0
+        for file, file_path in zip(files, file_paths):
+            file_size += await save_upload(file, file_path)
+        
+        # Validate query
+        if query == "" or query is None:
+            query = "Analyze this financial document for investment insights"
+        
+        # Get client IP
+        client_ip = request.client.host if request.client else None
+        
+        # Create a single database record for the whole batch
+        db_request = AnalysisRequest(
+            job_id=job_id,
+            filename=", ".join(filenames)[:255],
+            query=query,
+            status="pending",
+            batch_size=len(files)
+        )
+        db.add(db_request)
+        await asyncio.to_thread(db.commit)
+        
+        # Submit one Celery task for all files
+        analyze_financial_document_batch_celery.delay(
+            job_id=job_id,
+            file_paths=file_paths,
+            query=query.strip(),
+            filenames=filenames,
+            user_ip=client_ip,
+            file_size=file_size
+        )
+        
+        return {
+            "status": "submitted",
+            "job_id": job_id,
+            "message": "Documents submitted for batch analysis. Use /status/{job_id} to check progress.",
+            "filenames": filenames,
+            "batch_size": len(files),
+            "query": query
+        }
+        
+    except Exception as e:
+        # Clean up on error
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                try:
+                    os.remove(file_path)
+                except:
+                    pass
+        raise HTTPException(status_code=500, detail=f"Error submitting documents for batch analysis: {str(e)}")
+
+
+# The read endpoints below only do blocking SQLAlchemy queries, so they are plain
+# functions: FastAPI runs them in its threadpool instead of on the event loop.
+@app.get("/status/{job_id}", deprecated=True)
+def get_job_status(job_id: str, db: Session = Depends(get_db)):
     """
     Check the status of an analysis job.
+    Deprecated in favour of /status/{job_id}/stream, which pushes updates instead of being polled.
     
     Status values:
     - pending: Job submitted, waiting to be processed
@@ -212,6 +478,10 @@ async def get_job_status(job_id: str, db: Session = Depends(get_db)):
     - completed: Analysis finished successfully
     - failed: Analysis failed with an error
     """
+    cached = cache_get(status_key(job_id))
+    if cached:
+        return cached
+    
     db_request = db.query(AnalysisRequest).filter(AnalysisRequest.job_id == job_id).first()
     
     if not db_request:
@@ -222,6 +492,7 @@ async def get_job_status(job_id: str, db: Session = Depends(get_db)):
         "status": db_request.status,
         "filename": db_request.filename,
         "query": db_request.query,
+        "batch_size": db_request.batch_size,
         "created_at": db_request.created_at.isoformat(),
         "updated_at": db_request.updated_at.isoformat()
     }
@@ -233,14 +504,101 @@ async def get_job_status(job_id: str, db: Session = Depends(get_db)):
         response["error"] = db_request.error_message
         response["completed_at"] = db_request.completed_at.isoformat() if db_request.completed_at else None
     
+    cache_set(status_key(job_id), response, STATUS_TTL)
     return response
 
 
+@app.get("/status/{job_id}/stream")
+async def stream_job_status(job_id: str, db: Session = Depends(get_db)):
+    """
+    Stream status updates for an analysis job as Server-Sent Events.
+    
+    Sends the current status immediately, then one event per status change
+    published by the worker, and closes once the job is completed or failed.
+    Pub/sub messages can be lost (e.g. while Redis restarts), so the database is
+    re-checked on every keep-alive; the stream ends after STATUS_STREAM_DEADLINE
+    seconds with a "timeout" event regardless.
+    
+    Requires: Redis
+    """
+    if async_redis_client is None:
+        raise HTTPException(status_code=503, detail="Status streaming not available. Redis not configured. Use /status/{job_id} instead.")
+    
+    # Subscribe before reading the current status so no transition is missed in between
+    pubsub = async_redis_client.pubsub()
+    try:
+        await pubsub.subscribe(status_channel(job_id))
+    except Exception as e:
+        await pubsub.aclose()
+        raise HTTPException(status_code=503, detail=f"Status streaming not available: {str(e)}")
+    
+    db_request = await asyncio.to_thread(
+        lambda: db.query(AnalysisRequest).filter(AnalysisRequest.job_id == job_id).first()
+    )
+    if not db_request:
+        await pubsub.aclose()
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    def status_event(db_request) -> dict:
+        event = {"job_id": job_id, "status": db_request.status}
+        if db_request.status == "failed":
+            event["error"] = db_request.error_message
+        return event
+    
+    def read_status() -> dict:
+        # A fresh session: the request's one isn't meant to outlive the handler
+        with SessionLocal() as session:
+            return status_event(session.query(AnalysisRequest).filter(AnalysisRequest.job_id == job_id).first())
+    
+    current = status_event(db_request)
+    
+    async def events():
+        nonlocal current
+        deadline = time.monotonic() + STATUS_STREAM_DEADLINE
+        try:
+            yield f"data: {json.dumps(current)}\n\n"
+            if current["status"] in ("completed", "failed"):
+                return
+            
+            while (remaining := deadline - time.monotonic()) > 0:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=min(STATUS_STREAM_KEEPALIVE, remaining)
+                )
+                if message is None:
+                    latest = await asyncio.to_thread(read_status)
+                    if latest["status"] != current["status"]:
+                        current = latest
+                        yield f"data: {json.dumps(current)}\n\n"
+                        if current["status"] in ("completed", "failed"):
+                            return
+                    else:
+                        # Keep idle proxies from closing the connection
+                        yield ": keep-alive\n\n"
+                    continue
+                
+                data = message["data"].decode()
+                current = json.loads(data)
+                yield f"data: {data}\n\n"
+                if current["status"] in ("completed", "failed"):
+                    return
+            
+            yield f"event: timeout\ndata: {json.dumps(current)}\n\n"
+        finally:
+            await pubsub.aclose()
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 @app.get("/result/{job_id}")
-async def get_job_result(job_id: str, db: Session = Depends(get_db)):
+def get_job_result(job_id: str, db: Session = Depends(get_db)):
     """
     Retrieve the analysis result for a completed job.
     """
+    # Cached results are already serialized JSON, so send them as-is
+    cached = cache_get_raw(result_key(job_id))
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    
     db_result = db.query(AnalysisResult).filter(AnalysisResult.job_id == job_id).first()
     
     if not db_result:
@@ -259,41 +617,66 @@ async def get_job_result(job_id: str, db: Session = Depends(get_db)):
                 )
         raise HTTPException(status_code=404, detail="Result not found")
     
-    return {
-        "status": "success",
-        "job_id": job_id,
-        "filename": db_result.filename,
-        "query": db_result.query,
-        "analysis": db_result.analysis,
-        "processing_time": db_result.processing_time,
-        "created_at": db_result.created_at.isoformat()
-    }
+    response = result_payload(
+        job_id,
+        db_result.filename,
+        db_result.query,
+        db_result.analysis,
+        db_result.processing_time,
+        db_result.created_at
+    )
+    cache_set(result_key(job_id), response, RESULT_TTL)
+    return response
 
 
 @app.get("/history")
-async def get_analysis_history(
+def get_analysis_history(
     limit: int = Query(default=10, ge=1, le=100),
     offset: int = Query(default=0, ge=0),
+    cursor: Optional[str] = Query(default=None),
     db: Session = Depends(get_db)
-):
+) -> HistoryPage:
     """
     Retrieve analysis history with pagination.
     
     Parameters:
     - limit: Number of records to return (1-100, default: 10)
     - offset: Number of records to skip (default: 0)
+    - cursor: next_cursor from a previous page; seeks directly past that page
+      instead of skipping rows, and takes precedence over offset
     """
-    total = db.query(AnalysisResult).count()
-    results = db.query(AnalysisResult)\
-        .order_by(AnalysisResult.created_at.desc())\
-        .limit(limit)\
-        .offset(offset)\
-        .all()
+    # Newest first by id: ids are assigned in insert order, and unlike created_at
+    # (whole seconds on SQLite) they are unique, so the cursor never repeats a row
+    query = db.query(AnalysisResult)\
+        .order_by(AnalysisResult.id.desc())
+    
+    if cursor:
+        try:
+            last_id = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        results = query\
+            .filter(AnalysisResult.id < last_id)\
+            .limit(limit)\
+            .all()
+        # Cursor pages skip the full-table count
+        total = None
+    else:
+        total = db.query(AnalysisResult).count()
+        results = query\
+            .limit(limit)\
+            .offset(offset)\
+            .all()
+    
+    next_cursor = None
+    if len(results) == limit:
+        next_cursor = str(results[-1].id)
     
     return {
         "total": total,
         "limit": limit,
         "offset": offset,
+        "next_cursor": next_cursor,
         "results": [
             {
                 "job_id": r.job_id,
@@ -308,35 +691,37 @@ async def get_analysis_history(
 
 
 @app.get("/stats")
-async def get_statistics(db: Session = Depends(get_db)):
+def get_statistics(db: Session = Depends(get_db)):
     """
     Get usage statistics and analytics.
     """
-    total_analyses = db.query(AnalysisResult).count()
-    total_requests = db.query(AnalysisRequest).count()
-    
-    pending = db.query(AnalysisRequest).filter(AnalysisRequest.status == "pending").count()
-    processing = db.query(AnalysisRequest).filter(AnalysisRequest.status == "processing").count()
-    completed = db.query(AnalysisRequest).filter(AnalysisRequest.status == "completed").count()
-    failed = db.query(AnalysisRequest).filter(AnalysisRequest.status == "failed").count()
+    # One GROUP BY pass over requests instead of a COUNT per status
+    status_counts = dict(
+        db.execute(
+            select(AnalysisRequest.status, func.count()).group_by(AnalysisRequest.status)
+        ).all()
+    )
+    total_requests = sum(status_counts.values())
     
-    # Calculate average processing time
-    from sqlalchemy import func
-    avg_time = db.query(func.avg(AnalysisResult.processing_time)).scalar()
+    # Result count and average processing time in a single aggregate
+    total_analyses, avg_time = db.execute(
+        select(func.count(), func.avg(AnalysisResult.processing_time))
+    ).one()
     
     # Get success rate
-    total_activity = db.query(UserActivity).count()
-    successful_activity = db.query(UserActivity).filter(UserActivity.success == True).count()
+    total_activity, successful_activity = db.execute(
+        select(func.count(), func.sum(case((UserActivity.success == True, 1), else_=0)))
+    ).one()
     success_rate = (successful_activity / total_activity * 100) if total_activity > 0 else 0
     
     return {
         "total_analyses_completed": total_analyses,
         "total_requests": total_requests,
         "status_breakdown": {
-            "pending": pending,
-            "processing": processing,
-            "completed": completed,
-            "failed": failed
+            "pending": status_counts.get("pending", 0),
+            "processing": status_counts.get("processing", 0),
+            "completed": status_counts.get("completed", 0),
+            "failed": status_counts.get("failed", 0)
         },
         "average_processing_time_seconds": round(avg_time, 2) if avg_time else None,
         "success_rate_percentage": round(success_rate, 2),
@@ -0,0 +1,112 @@
+"""
+PDF text extraction used by the reader tools, including the process pool that
+extracts large documents in parallel. Kept free of CrewAI and the app modules so
+extraction worker processes only need to import PyMuPDF. (Like any non-fork
+multiprocessing worker, they also re-import the launching script, so run the API
+with the uvicorn command rather than "python main.py".)
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# PDF backend, imported once per process (including extraction workers); the reader
+# tools report an error instead of raising when it's missing
+try:
+    import pymupdf as PDF_BACKEND
+except ImportError:
+    PDF_BACKEND = None
+
+# Large documents are split into page ranges extracted in separate processes
+PARALLEL_MIN_PAGES = 100
+PARALLEL_MIN_BYTES = 10 * 1024 * 1024
+N_WORKERS = min(os.cpu_count() or 1, 8)
+
+# Built on first use and reused. Workers come from a forkserver rather than being
+# forked from the caller, which may be running uvicorn and crew threads
+# whose locks a forked child could inherit mid-acquire.
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def page_text(page) -> str:
+    """Cleaned text of one page"""
+    # Text blocks come already segmented into paragraphs, so joining the
+    # non-empty ones leaves no blank-line runs to clean up; image blocks
+    # (type 1) are skipped
+    blocks = page.get_text("blocks")
+    return "\n".join(text for block in blocks if block[6] == 0 and (text := block[4].strip()))
+
+
+def iter_doc_pages(doc, start: int = 0, end: int = None):
+    """
+    Yield (page_number, text) for the non-empty pages in [start, end) of an open
+    document, extracting one page at a time so only the current page's text is
+    held in memory
+    """
+    end = doc.page_count if end is None else min(end, doc.page_count)
+    for page_number in range(start, end):
+        content = page_text(doc[page_number])
+        if content:
+            yield page_number, content
+
+
+def iter_pages(file_path: str, start: int = 0, end: int = None):
+    """Open a PDF and yield (page_number, text) for its non-empty pages in [start, end)"""
+    with PDF_BACKEND.open(file_path) as doc:
+        yield from iter_doc_pages(doc, start, end)
+
+
+def extract_pages(doc, start: int, end: int) -> list:
+    """Cleaned text of the non-empty pages in [start, end) of an open document"""
+    return [content for _, content in iter_doc_pages(doc, start, end)]
+
+
+def extract_range(file_path: str, start: int, end: int) -> list:
+    """Worker-process entry point: open the PDF itself and extract one page range"""
+    return [content for _, content in iter_pages(file_path, start, end)]
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """The shared extraction pool, rebuilt if this process was forked since it was made"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                # The server imports this module (and PyMuPDF) once; workers fork from it
+                context.set_forkserver_preload([__name__])
+            else:
+                # No forkserver on Windows; spawned workers are just as clean
+                context = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=context)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _discard_pool():
+    """Drop a broken pool so the next call builds a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def extract_pages_parallel(file_path: str, page_count: int) -> list:
+    """Extract a large PDF across N_WORKERS processes, keeping page order"""
+    step = -(-page_count // N_WORKERS)
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    try:
+        pool = _get_pool()
+        futures = [pool.submit(extract_range, file_path, start, end) for start, end in ranges]
+        return [page for future in futures for page in future.result()]
+    except BrokenProcessPool:
+        _discard_pool()
+        return extract_range(file_path, 0, page_count)
+    except (OSError, AssertionError, ValueError):
+        # Processes can't always be started here (e.g. inside daemonic
+        # processes, or without a usable start method); extract serially instead
+        return extract_range(file_path, 0, page_count)
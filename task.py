@@ -1,16 +1,31 @@
 ## Importing libraries and files
+import os
+from typing import List
+from pydantic import BaseModel
 from crewai import Task
 
-from agents import financial_analyst, verifier
-from tools import search_tool, read_financial_document
+from agents import financial_analyst, document_reader, verifier, investment_advisor, risk_assessor
+from tools import read_financial_document
 
-## Creating a task to help solve user's query
-analyze_financial_document_task = Task(
-    description="""Analyze the financial document located at: {file_path}
+## By default the crews run only the financial analysis. With FULL_REVIEW=1 they run
+##   verification_task + the three analyses -> comprehensive_report_task
+## Verification and the analysis, investment and risk tasks only depend on the input
+## document, so in a full review they are asynchronous and run concurrently, each on
+## its own agent (an Agent cannot run two tasks at once); the report task waits for all
+## four, merges the analyses and qualifies them by the verification verdict.
+FULL_REVIEW = os.getenv("FULL_REVIEW", "").lower() in ("1", "true")
 
-User's query: {query}
+## Shared prompt fragments. Descriptions are assembled from these once at import, and
+## only the {file_path} and {query} placeholders are left for CrewAI to fill in.
+_DOCUMENT = "the financial document located at: {file_path}"
+_QUERY = "\n\nUser query: {query}\n\n"
+_DISCLAIMER = "\n- Clear disclaimer about the analysis being informational only"
 
-Your analysis should include:
+## Creating a task to help solve user's query
+analyze_financial_document_task = Task(
+    description="".join([
+        "Analyze ", _DOCUMENT, _QUERY,
+        """Your analysis should include:
 1. Use the read_financial_document tool with the file path: {file_path}
 2. Extract and summarize key financial metrics from the document
 3. Identify relevant trends, ratios, and performance indicators
@@ -20,6 +35,7 @@ Your analysis should include:
 
 Use the provided tools to read and analyze the financial document thoroughly.
 Be accurate, professional, and cite specific figures from the document.""",
+    ]),
 
     expected_output="""A comprehensive financial analysis report that includes:
 - Executive summary addressing the user's specific query
@@ -31,22 +47,22 @@ Be accurate, professional, and cite specific figures from the document.""",
 
     agent=financial_analyst,
     tools=[read_financial_document],
-    async_execution=False,
+    # On its own there is nothing to run alongside, so it stays on the kickoff thread
+    async_execution=FULL_REVIEW,
 )
 
 ## Creating an investment analysis task
 investment_analysis_task = Task(
-    description="""Perform a detailed investment analysis based on the financial document.
-
-User query: {query}
-
-Your analysis should:
+    description="".join([
+        "Perform a detailed investment analysis based on ", _DOCUMENT, _QUERY,
+        """Your analysis should:
 1. Evaluate the financial health indicators from the document
 2. Assess valuation metrics and compare to industry standards
 3. Identify investment strengths and weaknesses
 4. Analyze cash flow, profitability, and growth metrics
 5. Consider market conditions and competitive positioning
 6. Provide balanced investment considerations based on the data""",
+    ]),
 
     expected_output="""A structured investment analysis including:
 - Financial health assessment with key ratios
@@ -54,27 +70,25 @@ Your analysis should:
 - SWOT analysis based on document data
 - Cash flow and profitability evaluation
 - Growth potential assessment
-- Balanced investment considerations with risk factors
-- Clear disclaimer about the analysis being informational only""",
+- Balanced investment considerations with risk factors""" + _DISCLAIMER,
 
-    agent=financial_analyst,
+    agent=investment_advisor,
     tools=[read_financial_document],
-    async_execution=False,
+    async_execution=True,
 )
 
 ## Creating a risk assessment task
 risk_assessment_task = Task(
-    description="""Conduct a comprehensive risk assessment based on the financial document.
-
-User query: {query}
-
-Your assessment should:
+    description="".join([
+        "Conduct a comprehensive risk assessment based on ", _DOCUMENT, _QUERY,
+        """Your assessment should:
 1. Identify financial risks present in the document
 2. Evaluate liquidity and solvency risks
 3. Assess market and operational risk factors
 4. Analyze debt levels and coverage ratios
 5. Identify any red flags or areas of concern
 6. Provide risk mitigation considerations""",
+    ]),
 
     expected_output="""A detailed risk assessment report including:
 - Summary of identified risk factors
@@ -86,25 +100,31 @@ Your assessment should:
 - Risk mitigation considerations
 - Overall risk rating with justification""",
 
-    agent=financial_analyst,
+    agent=risk_assessor,
     tools=[read_financial_document],
-    async_execution=False,
+    async_execution=True,
 )
 
+## Structured verification verdict, so the verifier can finish on its first valid answer
+class VerificationResult(BaseModel):
+    verified: bool
+    reasons: List[str]
+
+
 ## Creating a verification task
 verification_task = Task(
-    description="""Verify that the uploaded document is a valid financial document.
-
-Verification steps:
+    description="".join([
+        "Verify that ", _DOCUMENT, " is a valid financial document.\n\n",
+        """Verification steps:
 1. Check if the document contains financial data (numbers, currencies, dates)
 2. Verify presence of standard financial document elements
 3. Identify the type of financial document (balance sheet, income statement, annual report, etc.)
 4. Check for data consistency and completeness
 5. Flag any anomalies or concerns about document validity""",
+    ]),
 
-    expected_output="""A verification report including:
+    expected_output="""A single JSON object {"verified": true/false, "reasons": [...]} where reasons cover:
 - Document type classification
-- Validation status (valid financial document or not)
 - List of financial elements found in the document
 - Data quality assessment
 - Any concerns or anomalies identified
@@ -112,5 +132,47 @@ Verification steps:
 
     agent=verifier,
     tools=[read_financial_document],
-    async_execution=False
-)
\ No newline at end of file
+    output_json=VerificationResult,
+    async_execution=FULL_REVIEW
+)
+
+
+## Creating the aggregation task that merges the concurrent analyses and verification
+comprehensive_report_task = Task(
+    description="".join([
+        "Combine the financial analysis, investment analysis and risk assessment of ",
+        _DOCUMENT, " into a single report.", _QUERY,
+        """Your report should:
+1. Answer the user's query directly, drawing on all three analyses
+2. Reconcile any differences between the analyses and explain them
+3. Keep every figure traceable to the document
+4. Avoid repeating the same findings across sections
+5. If verification did not confirm a valid financial document, say so first and limit
+   the report to what the document actually supports""",
+    ]),
+
+    expected_output="""A consolidated report including:
+- Executive summary addressing the user's specific query
+- Key financial metrics and trends
+- Investment considerations
+- Risk factors and overall risk rating""" + _DISCLAIMER,
+
+    agent=financial_analyst,
+    context=[verification_task, analyze_financial_document_task, investment_analysis_task, risk_assessment_task],
+    async_execution=False,
+)
+
+
+## Tasks and agents of the crews run by the API and the Celery worker
+if FULL_REVIEW:
+    crew_tasks = [
+        verification_task,
+        analyze_financial_document_task,
+        investment_analysis_task,
+        risk_assessment_task,
+        comprehensive_report_task,
+    ]
+    crew_agents = [financial_analyst, document_reader, verifier, investment_advisor, risk_assessor]
+else:
+    crew_tasks = [analyze_financial_document_task]
+    crew_agents = [financial_analyst, document_reader]
@@ -1,18 +1,169 @@
 ## Importing libraries and files
 import os
+import re
+import json
+import hashlib
+import time
+import functools
+import contextlib
+from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv()
 
 from crewai.tools import tool
 from crewai_tools import SerperDevTool
 
+from pdf_extraction import PDF_BACKEND, PARALLEL_MIN_PAGES, PARALLEL_MIN_BYTES, page_text, iter_pages, extract_pages, extract_pages_parallel
+
+# Any run of whitespace, collapsed to a single space when normalizing data
+_WS = re.compile(r"\s+")
+# Characters tallied by the risk scanner
+_DIGITS = "0123456789"
+_CURRENCY_SYMBOLS = "$€£¥"
+
 ## Creating search tool (requires SERPER_API_KEY environment variable)
-search_tool = None
-if os.getenv("SERPER_API_KEY"):
-    search_tool = SerperDevTool()
+@functools.cache
+def get_search_tool():
+    """Shared SerperDevTool, built on first use, or None without SERPER_API_KEY"""
+    if os.getenv("SERPER_API_KEY"):
+        return SerperDevTool()
+    return None
+
+## Job-scoped memory of tool outputs: {file_path: {tool_name: {args_hash: output}}}
+# Uploaded files are named after their job id, so each job gets its own entry,
+# which the caller drops with clear_tool_cache() once the job is done.
+_tool_output_cache = {}
+
+
+def cache_tool_output(func):
+    """Serve repeated calls with the same file_path and arguments from memory"""
+    @functools.wraps(func)
+    def wrapper(file_path: str = 'data/sample.pdf', **kwargs):
+        args_hash = hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()
+        outputs = _tool_output_cache.setdefault(file_path, {}).setdefault(func.__name__, {})
+        if args_hash in outputs:
+            return outputs[args_hash]
+        result = func(file_path, **kwargs)
+        # Errors are not remembered so a later call can still succeed
+        if not result.startswith("Error"):
+            outputs[args_hash] = result
+        return result
+    return wrapper
+
+
+def clear_tool_cache(file_path: str):
+    """Forget all cached tool outputs for a document"""
+    _tool_output_cache.pop(file_path, None)
+
+
+## Persistent cache of extracted PDF text, keyed by the SHA-256 of the file bytes.
+# Documents never change once uploaded, so any copy or re-upload of the same file
+# reuses the earlier extraction, and a changed file simply gets a new key.
+PDF_CACHE_DIR = Path(os.getenv("PDF_CACHE_DIR", ".cache/pdf"))
+HASH_CHUNK_SIZE = 1 << 16
+# Extracted text outlives the uploaded PDF, so entries are kept for a bounded time
+# and the directory for a bounded size
+PDF_CACHE_MAX_AGE = float(os.getenv("PDF_CACHE_MAX_AGE_HOURS", "24")) * 3600
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_MB", "500")) * 1024 * 1024
+
+
+def compute_file_hash(file_path: str) -> str:
+    """SHA-256 of a file, read in 64 KB chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_cached_text(file_hash: str):
+    """Return previously extracted text for a file hash, or None"""
+    cache_file = PDF_CACHE_DIR / f"{file_hash}.json"
+    try:
+        # Expired entries are misses even before an eviction pass removes them
+        if time.time() - cache_file.stat().st_mtime > PDF_CACHE_MAX_AGE:
+            return None
+        return json.loads(cache_file.read_text(encoding="utf-8"))["text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached_text(file_hash: str, text: str, source: str):
+    """Save extracted text for a file hash; failures only cost a future cache miss"""
+    cache_file = PDF_CACHE_DIR / f"{file_hash}.json"
+    try:
+        PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename, so concurrent readers never see a partial entry.
+        # Text is stored as plain UTF-8 rather than \uXXXX escapes, which would inflate
+        # non-ASCII symbols (€, £, em dashes) six-fold and slow both encode and decode
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps({"text": text, "source": source}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        return
+    evict_cached_text()
+
+
+def evict_cached_text():
+    """
+    Delete cache entries older than PDF_CACHE_MAX_AGE, then the oldest remaining
+    ones until the cache fits in PDF_CACHE_MAX_BYTES
+    """
+    entries = []
+    try:
+        with os.scandir(PDF_CACHE_DIR) as scan:
+            for entry in scan:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return
+    
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    now = time.time()
+    for mtime, size, path in entries:
+        if now - mtime <= PDF_CACHE_MAX_AGE and total_size <= PDF_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+
+
+def _extract_text(file_path: str) -> str:
+    """Text of a PDF, from the disk cache or a fresh extraction"""
+    file_hash = compute_file_hash(file_path)
+    cached_text = load_cached_text(file_hash)
+    if cached_text is not None:
+        return cached_text
+    
+    doc = PDF_BACKEND.open(file_path)
+    
+    try:
+        page_count = doc.page_count
+        is_large = page_count > PARALLEL_MIN_PAGES or os.path.getsize(file_path) > PARALLEL_MIN_BYTES
+        pages = None if is_large else extract_pages(doc, 0, page_count)
+    finally:
+        doc.close()
+    
+    if pages is None:
+        pages = extract_pages_parallel(file_path, page_count)
+    
+    full_report = "\n".join(pages)
+    if full_report:
+        store_cached_text(file_hash, full_report, file_path)
+    return full_report
+
 
 ## Creating custom pdf reader tool
 @tool("Read Financial Document")
+@cache_tool_output
 def read_financial_document(file_path: str = 'data/sample.pdf') -> str:
     """Tool to read and extract text content from a PDF financial document.
 
@@ -22,22 +173,56 @@ def read_financial_document(file_path: str = 'data/sample.pdf') -> str:
     Returns:
         str: Full text content of the financial document.
     """
+    if PDF_BACKEND is None:
+        return "Error reading PDF: PyMuPDF is not installed"
+    
     try:
-        from pypdf import PdfReader
+        # PyMuPDF reports missing files with its own exception type
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(file_path)
         
-        reader = PdfReader(file_path)
-        full_report = ""
+        # Repeat reads within a job are answered by cache_tool_output above
+        full_report = _extract_text(file_path)
+        if not full_report:
+            return "No text content found in the document."
+        
+        return full_report
+        
+    except FileNotFoundError:
+        return f"Error: File not found at path '{file_path}'"
+    except Exception as e:
+        return f"Error reading PDF: {str(e)}"
+
+
+@tool("Read Financial Document Pages")
+@cache_tool_output
+def read_financial_document_stream(file_path: str = 'data/sample.pdf', start_page: int = 1, max_pages: int = 10) -> str:
+    """Tool to read a range of pages from a PDF financial document, for documents too long to read at once.
+
+    Args:
+        file_path (str): Path to the PDF file to read. Defaults to 'data/sample.pdf'.
+        start_page (int): First page to read, counting from 1. Defaults to 1.
+        max_pages (int): Maximum number of pages to read. Defaults to 10.
+
+    Returns:
+        str: Text content of each page in the range, headed by its page number.
+    """
+    if PDF_BACKEND is None:
+        return "Error reading PDF: PyMuPDF is not installed"
+    
+    start = max(start_page, 1) - 1
+    end = start + max(max_pages, 1)
+    try:
+        # PyMuPDF reports missing files with its own exception type
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(file_path)
         
-        for page in reader.pages:
-            content = page.extract_text()
-            if content:
-                # Clean and format the financial document data
-                # Remove extra whitespaces and format properly
-                while "\n\n" in content:
-                    content = content.replace("\n\n", "\n")
-                full_report += content + "\n"
+        # Only the requested pages are extracted, never the whole document
+        pages = [f"--- Page {page_number + 1} ---\n{content}" for page_number, content in iter_pages(file_path, start, end)]
+        if not pages:
+            return f"No text content found in pages {start + 1}-{end} of the document."
         
-        return full_report if full_report else "No text content found in the document."
+        return "\n".join(pages)
         
     except FileNotFoundError:
         return f"Error: File not found at path '{file_path}'"
@@ -58,13 +243,19 @@ def analyze_investment_data(financial_data: str) -> str:
     if not financial_data:
         return "No financial data provided for analysis."
     
-    # Process and analyze the financial document data
-    processed_data = financial_data
-    
-    # Clean up the data format - remove excessive whitespace
-    processed_data = ' '.join(processed_data.split())
-    
-    return processed_data
+    # Clean up the data format - remove excessive whitespace in a single regex pass
+    # rather than splitting into a list of every token
+    return _WS.sub(" ", financial_data).strip()
+
+
+def _scan(text: str) -> tuple:
+    """Counts of digits, currency symbols and percent signs in text"""
+    # str.count runs in C, so a handful of passes beats one Python-level loop by far
+    return (
+        sum(map(text.count, _DIGITS)),
+        sum(map(text.count, _CURRENCY_SYMBOLS)),
+        text.count("%"),
+    )
 
 
 @tool("Assess Financial Risk")
@@ -80,5 +271,25 @@ def assess_financial_risk(financial_data: str) -> str:
     if not financial_data:
         return "No financial data provided for risk assessment."
     
-    # Basic risk assessment placeholder
-    return f"Risk assessment analysis completed for document with {len(financial_data)} characters of data."
\ No newline at end of file
+    # Basic risk assessment: how much numeric content the document carries
+    digits, currency_symbols, percentages = _scan(financial_data)
+    return (
+        f"Risk assessment analysis completed for document with {len(financial_data)} characters of data "
+        f"({digits} digits, {currency_symbols} currency symbols, {percentages} percentages)."
+    )
+
+
+def prewarm():
+    """Pay PyMuPDF's one-time setup (fonts, text tables) before the first real document"""
+    if PDF_BACKEND is None:
+        return
+    # A throwaway one-page document built in memory, so no sample file is needed
+    with contextlib.suppress(Exception), PDF_BACKEND.open() as doc:
+        page = doc.new_page()
+        page.insert_text((72, 72), "Revenue $1.0B, up 10%")
+        page_text(page)
+
+
+# Opt-in so short-lived processes and scripts don't pay for it
+if os.getenv("FA_PREWARM") == "1":
+    prewarm()